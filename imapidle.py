@@ -19,14 +19,16 @@ class IMAPIdle(Thread):
     def exit(self):
         self._exit = True
 
-    def start_idle(self):
+    def start_idle(self, selected=False):
         """
         start imap idle to hold the connection alive
+        idles on the already selected folder if selected is True
         """
         if self._idle is False:
             #: must select a folder before invoking idle. we simply select the first folder to idle on
-            _, _, some_folder = self.client.list_folders()[0]
-            self.client.select_folder(some_folder, readonly=True)
+            if selected is False:
+                _, _, some_folder = self.client.list_folders()[0]
+                self.client.select_folder(some_folder, readonly=True)
             self.client.idle()
             self._idle = time()
 
@@ -40,4 +42,4 @@ class IMAPIdle(Thread):
 
     def restart_idle(self):
         self.stop_idle()
-        self.start_idle()
+        self.start_idle(selected=True)  #: the folder is still selected
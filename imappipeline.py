@@ -0,0 +1,80 @@
+from imaplib import MapCRLF
+
+from imapclient.datetime_util import datetime_to_INTERNALDATE
+from imapclient.exceptions import IMAPClientError
+from imapclient.imapclient import seq_to_parenstr
+from imapclient.util import to_bytes
+
+
+class PipelinedAppender:
+    def __init__(self, client):
+        self.client = client
+        self._pending = []  #: tags of the sent commands or (status, response) tuples of already finished ones
+
+    @property
+    def pipelining(self):
+        """
+        without non-synchronizing literals (LITERAL+) every literal has to wait for a continuation response
+        """
+        return self.client.has_capability('LITERAL+')
+
+    def send_all(self, messages):
+        """
+        send an APPEND command for every (folder, msg, flags, msg_time) tuple without waiting for the responses
+        """
+        pipelining = self.pipelining
+
+        for folder, msg, flags, msg_time in messages:
+            try:
+                if pipelining:
+                    self._pending.append(self._send_append(folder, msg, flags, msg_time))
+                else:
+                    #: fallback: serial request/response
+                    self._pending.append(('OK', self.client.append(folder, msg, flags, msg_time=msg_time)))
+            except (IMAPClientError, OSError) as e:
+                self._pending.append(('NO', str(e).encode()))
+
+    def collect(self):
+        """
+        read the tagged responses of all sent commands
+        returns a list of (status, response) tuples in the order the messages were sent
+        the response of a failed command is the error message
+        """
+        imap = self.client._imap
+        results = []
+        pending, self._pending = self._pending, []
+
+        for tag in pending:
+            if isinstance(tag, tuple):
+                results.append(tag)
+                continue
+
+            try:
+                status, data = imap._get_tagged_response(tag)
+                if status != 'OK':
+                    #: the same message IMAPClient raises on the serial path
+                    data = [b'append failed: ' + data[0]]
+                results.append((status, data[0]))
+            except (IMAPClientError, OSError) as e:
+                #: usually the connection is broken, so the remaining commands will fail as well
+                imap.tagged_commands.pop(tag, None)
+                results.append(('NO', str(e).encode()))
+        return results
+
+    def _send_append(self, folder, msg, flags, msg_time):
+        imap = self.client._imap
+        tag = imap._new_tag()  #: registers the tag, so the response can be mapped back
+        msg = MapCRLF.sub(b'\r\n', to_bytes(msg))
+
+        command = [tag, b'APPEND', to_bytes(self.client._normalise_folder(folder)), to_bytes(seq_to_parenstr(flags))]
+        if msg_time:
+            command.append(to_bytes(f'"{datetime_to_INTERNALDATE(msg_time)}"'))
+        command.append(b'{%d+}' % len(msg))
+
+        try:
+            imap.send(b' '.join(command) + b'\r\n' + msg + b'\r\n')
+        except OSError as e:
+            #: the same error imaplib raises for a broken connection
+            imap.tagged_commands.pop(tag, None)
+            raise imap.abort(f'socket error: {e}')
+        return tag
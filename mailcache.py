@@ -0,0 +1,35 @@
+import sqlite3
+from os import makedirs, path
+
+
+class MailCache:
+    def __init__(self, filename):
+        makedirs(path.dirname(filename), exist_ok=True)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS mails (folder TEXT, uidvalidity INTEGER, uid INTEGER, '
+                                'size INTEGER, msg_id BLOB, subject_raw BLOB, PRIMARY KEY (folder, uidvalidity, uid))')
+
+    def load(self, folder, uidvalidity):
+        """
+        returns the cached (uid, size, msg_id, subject_raw) rows of the folder ordered by uid
+        the rows of another uidvalidity are invalid and will be dropped
+        """
+        with self.connection:
+            self.connection.execute('DELETE FROM mails WHERE folder = ? AND uidvalidity != ?', (folder, uidvalidity))
+        return self.connection.execute('SELECT uid, size, msg_id, subject_raw FROM mails '
+                                       'WHERE folder = ? AND uidvalidity = ? ORDER BY uid',
+                                       (folder, uidvalidity)).fetchall()
+
+    def update(self, folder, uidvalidity, mails, deleted=()):
+        """
+        add the (uid, size, msg_id, subject_raw) rows and remove the deleted uids in a single transaction
+        """
+        with self.connection:
+            self.connection.executemany('DELETE FROM mails WHERE folder = ? AND uidvalidity = ? AND uid = ?',
+                                        ((folder, uidvalidity, uid) for uid in deleted))
+            self.connection.executemany('INSERT OR REPLACE INTO mails VALUES (?, ?, ?, ?, ?, ?)',
+                                        ((folder, uidvalidity, *mail) for mail in mails))
+
+    def close(self):
+        self.connection.close()
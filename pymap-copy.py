@@ -7,13 +7,21 @@ __author__ = 'Lukas Schulte-Tickmann'
 __url__ = 'https://github.com/Schluggi/pymap-copy'
 
 import logging
+import ssl
+import sys
+from os import path, _exit
+from array import array
 from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Lock
 from time import time
 
 from imapclient import IMAPClient, exceptions
 
 from imapidle import IMAPIdle
-from utils import decode_mime, beautysized, imaperror_decode
+from mailcache import MailCache
+from imappipeline import PipelinedAppender
+from utils import decode_mime, beautysized, imaperror_decode, chunk_by_bytes, exceeds_line_length, Throttle
 
 
 def check_encryption(value):
@@ -36,24 +44,52 @@ def default_port(encryption):
     return 993
 
 
+#: ANSI escape code templates for every combination of color, bold and clear
+COLORS = {'red': '\x1b[31m',
+          'green': '\x1b[32m',
+          'cyan': '\x1b[36m',
+          'yellow': '\x1b[33m'}
+COLORIZE_TEMPLATES = {(color, bold, clear): '{}{}{}%s\x1b[0m'.format(COLORS.get(color, ''), '\x1b[1m' if bold else '',
+                                                                    '\r\x1b[2K' if clear else '')
+                      for color in (None, *COLORS) for bold in (False, True) for clear in (False, True)}
+
+
 def colorize(s, color=None, bold=False, clear=False):
     """
         turn the string into a colored and/or bold one
     """
-    colors = {'red': '\x1b[31m',
-              'green': '\x1b[32m',
-              'cyan': '\x1b[36m',
-              'yellow': '\x1b[33m'}
     if args.no_colors:
         return s
+    return COLORIZE_TEMPLATES[color, bold, clear] % s
+
+
+def write_progress(template, *values):
+    """
+        write a prebuilt progress template (bytes) directly to the binary stdout
+    """
+    template %= tuple(v.encode(STDOUT_ENCODING, 'replace') if isinstance(v, str) else v for v in values)
+
+    #: text-only streams (e.g. loggers or IDEs replacing sys.stdout) have no binary buffer
+    buffer = getattr(sys.stdout, 'buffer', None)
+    if buffer is None:
+        print(template.decode(STDOUT_ENCODING, 'replace'), end='', flush=True)
+        return
+
+    sys.stdout.flush()  #: the text layer may still hold some output
+    buffer.write(template)
+    buffer.flush()
 
-    if clear:
-        s = f'\r\x1b[2K{s}'
-    if bold:
-        s = f'\x1b[1m{s}'
-    if color:
-        s = f'{colors[color]}{s}'
-    return f'{s}\x1b[0m'
+
+def create_ssl_context():
+    """
+        returns the ssl context shared by all connections
+    """
+    context = ssl.create_default_context()
+
+    if args.ssl_no_verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
 
 
 def connect(server, port, encryption):
@@ -62,17 +98,10 @@ def connect(server, port, encryption):
         returns a client handle if connected and None if not
     """
     use_ssl = False
-    ssl_context = None  # IMAPClient will use a context by default if ssl_context is None
 
     if encryption in ['tls', 'ssl']:
         use_ssl = True
 
-    if args.ssl_no_verify:
-        import ssl
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE
-
     try:
         client = IMAPClient(host=server, port=port, ssl=use_ssl, ssl_context=ssl_context)
         if encryption == 'starttls':
@@ -110,8 +139,10 @@ def get_quota(client):
     """
         returns the quota of the mailbox
     """
-    if client.has_capability('QUOTA') and args.ignore_quota is False:
-        quota = client.get_quota()[0]
+    #: a single GETQUOTAROOT round trip, servers may return no quota at all
+    quotas = client.get_quota() if client.has_capability('QUOTA') and args.ignore_quota is False else None
+    if quotas:
+        quota = quotas[0]
         quota_usage = beautysized(quota.usage * 1000)
         quota_limit = beautysized(quota.limit * 1000)
         quota_filled = f'{quota.usage / quota.limit * 100:.0f}'
@@ -135,6 +166,14 @@ parser.add_argument('--abort-on-error', help='the process will interrupt at the
                     action="store_true")
 parser.add_argument('-b', '--buffer-size', help='the number of mails loaded with a single query (default: 50)',
                     nargs='?', type=int, default=50)
+parser.add_argument('--meta-buffer-size', help='the number of mail headers loaded with a single query while scanning '
+                                                 'the folders (default: 500)', nargs='?', type=int, default=500)
+parser.add_argument('--parallel-append', help='the number of destination connections used to append mails in '
+                                                'parallel (default: 1)', type=int, default=1)
+parser.add_argument('--single-pass', help='load small mails (< 256 KB) completely while scanning the folders, so '
+                                            'they are not fetched twice (needs more memory)', action='store_true')
+parser.add_argument('--no-cache', help='do not use the cached source metadata of previous runs (incremental mode '
+                                          'only)', action='store_true')
 parser.add_argument('--denied-flags', help='mails with this flags will be skipped', type=str)
 parser.add_argument('-r', '--redirect', help='redirect a folder (source:destination --denied-flags seen,recent -d)',
                     action='append')
@@ -176,6 +215,7 @@ parser.add_argument('--destination-no-subscribe', help='all copied folders will
                     action="store_true", default=False)
 
 args = parser.parse_args()
+args.source_folder = frozenset(args.source_folder)  #: checked for every folder of both servers
 
 if args.source_port:
     source_port = args.source_port
@@ -187,16 +227,24 @@ if args.destination_port:
 else:
     destination_port = default_port(args.destination_encryption)
 
+#: the certificates are loaded only once for all connections
+ssl_context = create_ssl_context()
+
 
 
 #: pre-defined variables
+STDOUT_ENCODING = getattr(sys.stdout, 'encoding', None) or 'utf-8'  #: text-only streams may have no encoding
 SPECIAL_FOLDER_FLAGS = [b'\\Archive', b'\\Junk', b'\\Drafts', b'\\Trash', b'\\Sent']
+SINGLE_PASS_MAX_SIZE = 256000
+SINGLE_PASS_MAX_MEMORY = 100000000  #: larger mailboxes fall back to fetching the rest during the copy
+MAX_COMMAND_LENGTH = 8000  #: some servers reject longer requests ("maximum request size exceeded")
 denied_flags = [b'\\recent']
 progress = 0
 destination_separator, source_separator = None, None
 db = {
     'source': {
-        'folders': {}
+        'folders': {},
+        'selected_folder': None
     },
     'destination': {
         'folders': {}
@@ -224,9 +272,11 @@ stats = {
     'copied_mails': 0,
     'copied_folders': 0
 }
+stats_lock = Lock()
 
 if args.denied_flags:
     denied_flags.extend([f'\\{flag}'.encode() for flag in args.denied_flags.lower().split(',')])
+denied_flags = frozenset(flag.lower() for flag in denied_flags)
 
 print()
 
@@ -283,7 +333,7 @@ print('Getting destination quota   : ', end='', flush=True)
 logging.info(f'Getting destination quota...')
 destination_quota, destination_quota_usage, destination_quota_limit, destination_quota_filled = get_quota(destination)
 if destination_quota:
-    print(f'{source_quota_usage}/{source_quota_limit} ({source_quota_filled}%)')
+    print(f'{destination_quota_usage}/{destination_quota_limit} ({destination_quota_filled}%)')
 else:
     destination_quota = None
     print('server does not support quota')
@@ -308,116 +358,252 @@ else:
 
 print()
 
-destination_idle.start_idle()
 wildcards = tuple([f[:-1] for f in args.source_folder if f.endswith('*')])
+#: no need to load any mail otherwise, in incremental mode most of them already exist at the destination
+single_pass = args.single_pass and not any((args.dry_run, args.list, args.incremental))
+
+
+def get_subject(folder, idx):
+    """
+        returns the decoded subject of a source mail
+        the raw subject is only decoded once, on the first call
+    """
+    subject = folder['subjects'][idx]
+    if not isinstance(subject, str):
+        subject = decode_mime(subject) if subject else '(no subject)'
+        folder['subjects'][idx] = subject
+    return subject
 
-#: get source folders
-print(colorize('Getting source folders      : loading (this can take a while)', clear=True), flush=True, end='')
-logging.info('Getting source folders (this can take a while)')
-for flags, separator, name in source.list_folders():
-    if not source_separator:
-        source_separator = separator.decode()
-
-    if args.source_folder:
-        if name not in args.source_folder and name.startswith(wildcards) is False:
-            print(colorize(f'Getting source folders      : Progressing ({stats["source_mails"]} mails) (skipping): '
-                           f'{name}', clear=True), flush=True, end='')
+
+def scan_source(db, stats):
+    """
+        get all source folders and the metadata of their mails
+        returns the folder separator of the source
+    """
+    separator = None
+    throttle = Throttle()
+    preload_budget = SINGLE_PASS_MAX_MEMORY  #: bytes of mail bodies single pass may still hold in memory
+
+    #: metadata cache of previous runs (sqlite objects can only be used in the thread that created them)
+    cache = None
+    if args.incremental and args.no_cache is False:
+        server = args.source_server.replace('/', '_')
+        user = args.source_user.replace('/', '_')
+        cache = MailCache(path.expanduser(f'~/.cache/pymap-copy/{user}@{server}.sqlite'))
+
+    for flags, folder_separator, name in source.list_folders():
+        if not separator:
+            separator = folder_separator.decode()
+
+        if args.source_folder:
+            if name not in args.source_folder and name.startswith(wildcards) is False:
+                if throttle.should_emit():
+                    with stats_lock:
+                        print(colorize(f'Getting source folders      : Progressing ({stats["source_mails"]} mails) '
+                                       f'(skipping): {name}', clear=True), flush=True, end='')
+                continue
+
+        try:
+            db['source']['selected_folder'] = None
+            folder_info = source.select_folder(name, readonly=True)
+            db['source']['selected_folder'] = name
+        except Exception as e:
+            error_information = {'size': 'unknown',
+                                 'subject': 'unknown',
+                                 'exception': str(e),
+                                 'folder': name,
+                                 'date': 'unknown',
+                                 'id': 'unknown'}
+            stats['skipped_folders']['no_parent'] += 1
+            stats['errors'].append(error_information)
             continue
 
-    try:
-        source.select_folder(name, readonly=True)
-    except Exception as e:
-        error_information = {'size': 'unknown',
-                             'subject': 'unknown',
-                             'exception': str(e),
-                             'folder': name,
-                             'date': 'unknown',
-                             'id': 'unknown'}
-        stats['skipped_folders']['no_parent'] += 1
-        stats['errors'].append(error_information)
-        continue
-
-    mails = source.search()
-
-    if not mails and args.skip_empty_folders:
-        continue
-
-    db['source']['folders'][name] = {'flags': flags,
-                                     'mails': {},
-                                     'size': 0,
-                                     'buffer': []}
-
-    #: generating mail buffer
-    while mails:
-        db['source']['folders'][name]['buffer'].append(mails[:args.buffer_size])
-
-        for mail_id, data in source.fetch(mails[:args.buffer_size], ['RFC822.SIZE', 'ENVELOPE']).items():
-            if b'ENVELOPE' not in data:  # Encountered message with no ENVELOPE? Skipping it
-                stats['skipped_mails']['no_envelope'] += 1
+        uidvalidity = folder_info.get(b'UIDVALIDITY')
+        cached, deleted = [], []
+        if cache and uidvalidity:
+            cached = cache.load(name, uidvalidity)
+
+        if cached:
+            #: only the mails added since the last run need to be scanned
+            highest_uid = cached[-1][0]
+            mails = [uid for uid in source.search(['UID', f'{highest_uid + 1}:*']) if uid > highest_uid]
+
+            #: some cached mails have been deleted in the meantime
+            if len(cached) + len(mails) != folder_info.get(b'EXISTS'):
+                existing = set(source.search())
+                deleted = [row[0] for row in cached if row[0] not in existing]
+                cached = [row for row in cached if row[0] in existing]
+        else:
+            mails = source.search()
+
+        if not mails and not cached and args.skip_empty_folders:
+            continue
+
+        #: the mail metadata is stored as parallel arrays (one entry per mail) to save memory
+        db['source']['folders'][name] = {'flags': flags,
+                                         'mail_ids': array('L'),
+                                         'sizes': array('Q'),
+                                         'subjects': [],
+                                         'msg_ids': [],
+                                         'bodies': {},  #: index -> (flags, msg, date) of mails loaded in single pass
+                                         'size': 0,
+                                         'uidvalidity': folder_info.get(b'UIDVALIDITY')}
+
+        progress_line = f'Getting source folders      : Progressing ({{}} mails): {name}'
+
+        folder = db['source']['folders'][name]
+
+        for mail_id, size, msg_id, subject in cached:
+            folder['mail_ids'].append(mail_id)
+            folder['sizes'].append(size)
+            folder['subjects'].append(subject)
+            folder['msg_ids'].append(msg_id)
+            folder['size'] += size
+
+        with stats_lock:
+            stats['source_mails'] += len(cached)
+
+        for meta_buffer in chunk_by_bytes(mails, MAX_COMMAND_LENGTH, args.meta_buffer_size):
+            preload = {}  #: mail id -> index of the small mails that are loaded completely in single pass
+
+            for mail_id, data in source.fetch(meta_buffer, ['RFC822.SIZE', 'ENVELOPE']).items():
+                if b'ENVELOPE' not in data:  # Encountered message with no ENVELOPE? Skipping it
+                    stats['skipped_mails']['no_envelope'] += 1
+                    continue
+
+                size = data[b'RFC822.SIZE']
+                if single_pass and 0 < size < SINGLE_PASS_MAX_SIZE and size <= preload_budget:
+                    preload_budget -= size
+                    preload[mail_id] = len(folder['mail_ids'])
+
+                folder['mail_ids'].append(mail_id)
+                folder['sizes'].append(size)
+                folder['subjects'].append(data[b'ENVELOPE'].subject)  #: decoded on demand by get_subject()
+                folder['msg_ids'].append(data[b'ENVELOPE'].message_id)
+                folder['size'] += size
+
+                with stats_lock:
+                    stats['source_mails'] += 1
+                    if throttle.should_emit():
+                        print(colorize(progress_line.format(stats['source_mails']), clear=True), flush=True,
+                              end='')
+
+            #: single pass: the bodies are loaded now, so the copy loop does not need to fetch them again
+            for chunk in chunk_by_bytes(preload, MAX_COMMAND_LENGTH, args.buffer_size):
+                for mail_id, data in source.fetch(chunk, ['FLAGS', 'RFC822', 'INTERNALDATE']).items():
+                    #: mails with an incomplete response are fetched again during the copy
+                    if mail_id in preload and all(key in data for key in (b'FLAGS', b'RFC822', b'INTERNALDATE')):
+                        folder['bodies'][preload[mail_id]] = (data[b'FLAGS'], data[b'RFC822'],
+                                                              data[b'INTERNALDATE'])
+
+        if cache and uidvalidity:
+            cache.update(name, uidvalidity, zip(folder['mail_ids'][len(cached):], folder['sizes'][len(cached):],
+                                                folder['msg_ids'][len(cached):], folder['subjects'][len(cached):]),
+                         deleted)
+
+        with stats_lock:
+            print(colorize(progress_line.format(stats['source_mails']), clear=True), flush=True, end='')
+
+    if cache:
+        cache.close()
+    return separator
+
+
+def scan_destination(db, stats):
+    """
+        get all destination folders and the metadata of their mails
+        returns the folder separator of the destination
+    """
+    separator = None
+    throttle = Throttle()
+
+    for flags, folder_separator, name in destination.list_folders(args.destination_root):
+        if not separator:
+            separator = folder_separator.decode()
+
+        #: no need to process the source destination mailbox if we skipped the source for it
+        if args.source_folder:
+            if name not in args.source_folder and name.startswith(wildcards) is False:
+                if throttle.should_emit():
+                    with stats_lock:
+                        print(colorize('Getting destination folders : Progressing ({} mails) (skipping): {}'.
+                                       format(stats['destination_mails'], name), clear=True), flush=True, end='')
                 continue
-            elif data[b'ENVELOPE'].subject:
-                subject = decode_mime(data[b'ENVELOPE'].subject)
-            else:
-                subject = '(no subject)'
 
-            db['source']['folders'][name]['mails'][mail_id] = {'size': data[b'RFC822.SIZE'],
-                                                               'subject': subject,
-                                                               'msg_id': data[b'ENVELOPE'].message_id}
-            db['source']['folders'][name]['size'] += data[b'RFC822.SIZE']
-            stats['source_mails'] += 1
+        db['destination']['folders'][name] = {'flags': flags, 'mails': {}, 'size': 0}
 
-            print(colorize('Getting source folders      : Progressing ({} mails): {}'.
-                           format(stats['source_mails'], name), clear=True), flush=True, end='')
+        destination.select_folder(name, readonly=True)
+        mails = destination.search()
 
-        del mails[:args.buffer_size]
+        progress_line = f'Getting destination folders : Progressing ({{}} mails): {name}'
 
-print(colorize(f'Getting source folders      : {stats["source_mails"]} mails in {len(db["source"]["folders"])} folders '
-               f'({beautysized(sum([f["size"] for f in db["source"]["folders"].values()]))}) ', clear=True), end='')
-if any((args.source_folder, args.destination_root)):
-    print(f'({colorize("filtered by arguments", color="yellow")})', end='')
-print()
+        fetch_data = ['RFC822.SIZE']
+        if args.incremental:
+            fetch_data.append('ENVELOPE')
 
-destination_idle.stop_idle()
-source_idle.start_idle()
+        for meta_buffer in chunk_by_bytes(mails, MAX_COMMAND_LENGTH, args.meta_buffer_size):
+            for mail_id, data in destination.fetch(meta_buffer, fetch_data).items():
+                db['destination']['folders'][name]['mails'][mail_id] = {'size': data[b'RFC822.SIZE']}
+                db['destination']['folders'][name]['size'] += data[b'RFC822.SIZE']
 
+                if args.incremental:
+                    db['destination']['folders'][name]['mails'][mail_id]['msg_id'] = data[b'ENVELOPE'].message_id
 
-#: get destination folders
-print(colorize('Getting destination folders : loading (this can take a while)', clear=True), flush=True, end='')
-logging.info('Getting destination folders (this can take a while)')
-for flags, separator, name in destination.list_folders(args.destination_root):
+                with stats_lock:
+                    stats['destination_mails'] += 1
+                    if throttle.should_emit():
+                        print(colorize(progress_line.format(stats['destination_mails']), clear=True), flush=True,
+                              end='')
 
-    if not destination_separator:
-        destination_separator = separator.decode()
+        with stats_lock:
+            print(colorize(progress_line.format(stats['destination_mails']), clear=True), flush=True, end='')
 
-    #: no need to process the source destination mailbox if we skipped the source for it
-    if args.source_folder:
-        if name not in args.source_folder and name.startswith(wildcards) is False:
-            print(colorize('Getting source folders      : Progressing ({} mails) (skipping): {}'.
-                           format(stats['source_mails'], name), clear=True), flush=True, end='')
-            continue
+        #: used for the existence check in incremental mode
+        if args.incremental:
+            db['destination']['folders'][name]['msg_id_set'] = frozenset(
+                m['msg_id'] for m in db['destination']['folders'][name]['mails'].values())
 
-    db['destination']['folders'][name] = {'flags': flags, 'mails': {}, 'size': 0}
+    return separator
 
-    destination.select_folder(name, readonly=True)
-    mails = destination.search()
 
-    fetch_data = ['RFC822.SIZE']
-    if args.incremental:
-        fetch_data.append('ENVELOPE')
+def scan_and_idle(scan, idle):
+    """
+        run the scan and hold the connection alive (idle) until the scan of the other server has finished
+        returns the folder separator of the scanned server
+    """
+    separator = scan(db, stats)
 
-    while mails:
-        for mail_id, data in destination.fetch(mails[:args.buffer_size], fetch_data).items():
-            db['destination']['folders'][name]['mails'][mail_id] = {'size': data[b'RFC822.SIZE']}
-            db['destination']['folders'][name]['size'] += data[b'RFC822.SIZE']
+    #: the last scanned source folder stays selected, so the copy loop does not need to select it again
+    idle.start_idle(selected=scan is scan_source and db['source']['selected_folder'] is not None)
+    return separator
 
-            if args.incremental:
-                db['destination']['folders'][name]['mails'][mail_id]['msg_id'] = data[b'ENVELOPE'].message_id
 
-            stats['destination_mails'] += 1
-            print(colorize('Getting destination folders : Progressing ({} mails): {}'.
-                           format(stats['destination_mails'], name), clear=True), flush=True, end='')
-        del mails[:args.buffer_size]
+#: get source and destination folders (both connections are independent, so they are scanned in parallel)
+print(colorize('Getting folders             : loading (this can take a while)', clear=True), flush=True, end='')
+logging.info('Getting source and destination folders (this can take a while)')
+scan_executor = ThreadPoolExecutor(max_workers=2)
+scans = [scan_executor.submit(scan_and_idle, scan_source, source_idle),
+         scan_executor.submit(scan_and_idle, scan_destination, destination_idle)]
+try:
+    #: short waits, otherwise ctrl+c is only handled when the scans have finished
+    while wait(scans, timeout=0.1).not_done:
+        pass
+    source_separator, destination_separator = [scan.result() for scan in scans]
+except KeyboardInterrupt:
+    #: the running scans can not be interrupted and would be waited for on exit (no zombie threads)
+    print('\n\nAbort!\n', flush=True)
+    _exit(1)
+scan_executor.shutdown()
+
+#: stop idle mode to allow normal commands
+source_idle.stop_idle()
+destination_idle.stop_idle()
 
+print(colorize(f'Getting source folders      : {stats["source_mails"]} mails in {len(db["source"]["folders"])} folders '
+               f'({beautysized(sum([f["size"] for f in db["source"]["folders"].values()]))}) ', clear=True), end='')
+if any((args.source_folder, args.destination_root)):
+    print(f'({colorize("filtered by arguments", color="yellow")})', end='')
+print()
 
 print(colorize('Getting destination folders : {} mails in {} folders ({}) '.
                format(stats['destination_mails'], len(db['destination']['folders']),
@@ -433,7 +619,7 @@ if args.list:
     #: list all source folders
     print(colorize('Source:', bold=True))
     for name in db['source']['folders']:
-        print(f'{name} ({len(db["source"]["folders"][name]["mails"])} mails, '
+        print(f'{name} ({len(db["source"]["folders"][name]["mail_ids"])} mails, '
               f'{beautysized(db["source"]["folders"][name]["size"])})')
 
     #: list all destination folders
@@ -451,6 +637,11 @@ if args.list:
     exit()
 
 
+#: folder names are translated from the source to the destination separator (str.translate needs single chars)
+separator_table = None
+if source_separator and destination_separator and len(source_separator) == len(destination_separator) == 1:
+    separator_table = str.maketrans(source_separator, destination_separator)
+
 #: redirections
 redirections = {}
 not_found = []
@@ -477,16 +668,72 @@ if args.redirect:
         else:
             redirections[r_source] = r_destination
 
-source_idle.stop_idle()
-
 if not_found:
     print('\n{} Source folder not found: {}\n'.format(colorize('Error:', color='red', bold=True), ', '.join(not_found)))
     exit()
 
+#: additional destination connections for parallel appending
+#: they are opened right before the copy, nothing holds them alive while the folders are scanned
+append_clients = [destination]
+if args.parallel_append > 1 and not args.dry_run:
+    print('Destination connections     : ', end='', flush=True)
+    for _ in range(args.parallel_append - 1):
+        client, status = connect(args.destination_server, destination_port, args.destination_encryption)
+        client_login_ok, status = login(client, args.destination_user, args.destination_pass)
+
+        #: most servers limit the connections per account (NO [LIMIT]), so we go on with the ones we already have
+        if client_login_ok is False:
+            if client:
+                client.shutdown()
+            print(f'{len(append_clients)}/{args.parallel_append} ({status})', end='')
+            break
+        append_clients.append(client)
+    else:
+        print(f'{len(append_clients)}/{args.parallel_append} {colorize("OK", color="green")}', end='')
+    print('\n')
+
+
+def append_mails(appender, lock, messages):
+    """
+        append the messages with the given appender
+        returns the (status, response) tuples in the order of the messages
+    """
+    with lock:
+        appender.send_all(messages)
+        return appender.collect()
+
+
+appenders = [(PipelinedAppender(client), Lock()) for client in append_clients]
+append_executor = ThreadPoolExecutor(max_workers=len(appenders))
+lower = bytes.lower
+
+#: limits of the copy loop (--max-mail-size 0 and --max-line-length 0 disable them, as before)
+max_mail_size = args.max_mail_size or float('inf')
+max_line_length = args.max_line_length or 0
+
 try:
     for sf_name in sorted(db['source']['folders'], key=lambda x: x.lower()):
-        source.select_folder(sf_name, readonly=True)
-        df_name = sf_name.replace(source_separator, destination_separator)
+        #: the last scanned folder is still selected
+        if db['source']['selected_folder'] != sf_name:
+            folder_info = source.select_folder(sf_name, readonly=True)
+            db['source']['selected_folder'] = sf_name
+
+            #: the scanned mail ids are only valid as long as the UIDVALIDITY has not been changed
+            if folder_info.get(b'UIDVALIDITY') != db['source']['folders'][sf_name]['uidvalidity']:
+                stats['errors'].append({'size': 'unknown',
+                                        'subject': 'unknown',
+                                        'exception': 'UIDVALIDITY has been changed since the folder was scanned',
+                                        'folder': sf_name,
+                                        'date': 'unknown',
+                                        'id': 'unknown'})
+                print(f'{colorize("Error:", color="red", bold=True)} UIDVALIDITY of {sf_name} has been changed since '
+                      f'the folder was scanned\n')
+                continue
+
+        if separator_table:
+            df_name = sf_name.translate(separator_table)
+        else:
+            df_name = sf_name.replace(source_separator, destination_separator)
 
         if args.destination_root:
             if args.destination_root_merge is False or \
@@ -509,7 +756,7 @@ try:
 
         if df_name in db['destination']['folders']:
             print('Current folder: {} ({} mails, {}) -> {} ({} mails, {})'.format(
-                sf_name, len(db['source']['folders'][sf_name]['mails']),
+                sf_name, len(db['source']['folders'][sf_name]['mail_ids']),
                 beautysized(db['source']['folders'][sf_name]['size']), df_name,
                 len(db['destination']['folders'][df_name]['mails']),
                 beautysized(db['destination']['folders'][df_name]['size'])))
@@ -518,14 +765,14 @@ try:
 
         else:
             print('Current folder: {} ({} mails, {}) -> {} (non existing)'.format(
-                sf_name, len(db['source']['folders'][sf_name]['mails']),
+                sf_name, len(db['source']['folders'][sf_name]['mail_ids']),
                 beautysized(db['source']['folders'][sf_name]['size']), df_name))
 
             #: creating non-existing folders
             if not args.dry_run:
                 print('Creating...', end='', flush=True)
 
-                if args.skip_empty_folders and not db['source']['folders'][sf_name]['mails']:
+                if args.skip_empty_folders and not db['source']['folders'][sf_name]['mail_ids']:
                     stats['skipped_folders']['empty'] += 1
                     print('{} \n'.format(colorize('Skipped! (skip-empty-folders mode)', color='cyan')))
                     continue
@@ -550,26 +797,81 @@ try:
         if args.dry_run:
             continue
 
-        for buffer_counter, buffer in enumerate(db['source']['folders'][sf_name]['buffer']):
-            print(colorize('[{:>5.1f}%] Progressing... (loading buffer {}/{})'.format(
-                progress, buffer_counter+1, len(db['source']['folders'][sf_name]['buffer'])), clear=True), end='')
+        folder = db['source']['folders'][sf_name]
+        buffer_count = sum(1 for _ in chunk_by_bytes(folder['mail_ids'], MAX_COMMAND_LENGTH, args.buffer_size))
+        progress_template = colorize(f'[%5.1f%%] Progressing... (buffer %d/{buffer_count}) (mail %d/%d) (%s) (%s): %s',
+                                     clear=True).encode(STDOUT_ENCODING, 'replace')
+        throttle = Throttle()
+
+        #: the buffers are limited by the number of mails and the length of the FETCH command
+        buffer_start = 0
+        for buffer_counter, mail_ids in enumerate(chunk_by_bytes(folder['mail_ids'], MAX_COMMAND_LENGTH,
+                                                                 args.buffer_size)):
+            #: index range of the buffer in the metadata arrays
+            buffer = range(buffer_start, buffer_start + len(mail_ids))
+            buffer_start = buffer.stop
+
+            if throttle.should_emit():
+                print(colorize('[{:>5.1f}%] Progressing... (loading buffer {}/{})'.format(
+                    progress, buffer_counter+1, buffer_count), clear=True), end='')
+
+            #: skip mails by their metadata, before their bodies are fetched
+            copy_mails = []  #: (position in the buffer, index) of the mails that will be fetched
+            for i, idx in enumerate(buffer):
+                size = folder['sizes'][idx]
+                skip_message = None
+
+                #: skip empty mails / zero sized
+                if size == 0:
+                    stats['skipped_mails']['zero_size'] += 1
+                    skip_message = 'Skipped! (zero sized)'
+
+                #: skip too large mails
+                elif size > max_mail_size:
+                    stats['skipped_mails']['max_size'] += 1
+                    skip_message = 'Skipped! (too large)'
+
+                #: skip mails that already exist
+                elif args.incremental and df_name in db['destination']['folders'] and \
+                        folder['msg_ids'][idx] in db['destination']['folders'][df_name]['msg_id_set']:
+                    stats['skipped_mails']['already_exists'] += 1
+
+                else:
+                    copy_mails.append((i, idx))
+                    continue
+
+                stats['processed'] += 1
+                folder['bodies'].pop(idx, None)
+
+                if skip_message:
+                    progress = stats['processed'] / stats['source_mails'] * 100
+                    write_progress(progress_template, progress, buffer_counter+1, i+1, len(buffer), beautysized(size),
+                                   '(unknown)', get_subject(folder, idx))
+                    print('\n{} \n'.format(colorize(skip_message, color='cyan')), end='')
 
-            for i, fetch in enumerate(source.fetch(buffer, ['FLAGS', 'RFC822', 'INTERNALDATE']).items()):
+            #: mails loaded in single pass are already there
+            fetch_mails = [folder['mail_ids'][idx] for _, idx in copy_mails if idx not in folder['bodies']]
+            fetch_data = source.fetch(fetch_mails, ['FLAGS', 'RFC822', 'INTERNALDATE']) if fetch_mails else {}
+
+            appends = []  #: the mails of this buffer that will be appended to the destination
+            for i, idx in copy_mails:
                 progress = stats['processed'] / stats['source_mails'] * 100
-                mail_id, data = fetch
 
                 #: placeholders, so we can still attempt to use them in error reporting
-                flags = msg = date = size = subject = "(unknown)"
+                flags = msg = date = size = "(unknown)"
                 msg_id = b"(unknown)"
 
                 try:
-                    msg_id = db['source']['folders'][sf_name]['mails'][mail_id]['msg_id']
-                    size = db['source']['folders'][sf_name]['mails'][mail_id]['size']
-                    subject = db['source']['folders'][sf_name]['mails'][mail_id]['subject']
-                    
-                    flags = data[b'FLAGS']
-                    msg = data[b'RFC822']
-                    date = data[b'INTERNALDATE']
+                    msg_id = folder['msg_ids'][idx]
+                    size = folder['sizes'][idx]
+
+                    if idx in folder['bodies']:
+                        flags, msg, date = folder['bodies'].pop(idx)
+                    else:
+                        data = fetch_data[folder['mail_ids'][idx]]
+                        flags = data[b'FLAGS']
+                        msg = data[b'RFC822']
+                        date = data[b'INTERNALDATE']
 
                 except KeyError as e:
                     try:
@@ -578,7 +880,7 @@ try:
                         msg_id_decoded = f'(decode failure): {sub_exception}'
 
                     stats['errors'].append({'size': size,
-                                            'subject': subject,
+                                            'subject': get_subject(folder, idx),
                                             'exception': f'{type(e).__name__}: {e}',
                                             'folder': df_name,
                                             'date': date,
@@ -587,73 +889,69 @@ try:
                     continue
 
                 #: copy mail
-                print(colorize('[{:>5.1f}%] Progressing... (buffer {}/{}) (mail {}/{}) ({}) ({}): {}'.format(
-                    progress, buffer_counter+1, len(db['source']['folders'][sf_name]['buffer']), i+1, len(buffer),
-                    beautysized(size), date, subject), clear=True), end='')
-
-                #: skip empty mails / zero sized
-                if size == 0:
-                    stats['skipped_mails']['zero_size'] += 1
-                    stats['processed'] += 1
-                    print('\n{} \n'.format(colorize('Skipped! (zero sized)', color='cyan')), end='')
-
-                #: skip too large mails
-                elif args.max_mail_size and size > args.max_mail_size:
-                    stats['skipped_mails']['max_size'] += 1
-                    stats['processed'] += 1
-                    print('\n{} \n'.format(colorize('Skipped! (too large)', color='cyan')), end='')
+                skip_message = None
 
-                #: skip mails that already exist
-                elif args.incremental and df_name in db['destination']['folders'] and \
-                        msg_id in [m['msg_id'] for m in db['destination']['folders'][df_name]['mails'].values()]:
-                    stats['skipped_mails']['already_exists'] += 1
+                #: workaround for microsoft exchange server
+                if max_line_length and exceeds_line_length(msg, max_line_length):
+                    stats['skipped_mails']['max_line_length'] += 1
                     stats['processed'] += 1
-
-                elif args.dry_run:
-                    pass
-
+                    skip_message = 'Skipped! (line length)'
                 else:
-                    try:
-                        #: workaround for microsoft exchange server
-                        if args.max_line_length:
-                            if any([len(line) > args.max_line_length for line in msg.split(b'\n')]):
-                                stats['skipped_mails']['max_line_length'] += 1
-                                print('\n{} \n'.format(colorize('Skipped! (line length)', color='cyan')), end='')
-                                continue
-
-                        status = destination.append(df_name, msg, (flag for flag in flags if flag.lower() not in
-                                                                   denied_flags), msg_time=date)
-
-                        #: differed IMAP servers have differed return codes
-                        success_messages = [b'append completed', b'(success)']
-                        if any([msg in status.lower() for msg in success_messages]):
-                            stats['copied_mails'] += 1
-                        else:
-                            raise exceptions.IMAPClientError(f'Unknown success message: {status.decode()}')
+                    appends.append({'msg': msg,
+                                    'flags': [flag for flag in flags if lower(flag) not in denied_flags],
+                                    'date': date,
+                                    'size': size,
+                                    'idx': idx,
+                                    'msg_id': msg_id})
+
+                #: skipped mails are always shown, so the message refers to the right mail
+                if skip_message or throttle.should_emit():
+                    write_progress(progress_template, progress, buffer_counter+1, i+1, len(buffer), beautysized(size),
+                                   str(date), get_subject(folder, idx))
+                if skip_message:
+                    print('\n{} \n'.format(colorize(skip_message, color='cyan')), end='')
+
+            #: split the buffer across the destination connections, each of them pipelines its APPEND commands
+            chunk_size = -(-len(appends) // len(appenders))
+            futures = [append_executor.submit(append_mails, appender, lock,
+                                              [(df_name, mail['msg'], mail['flags'], mail['date'])
+                                               for mail in appends[i * chunk_size:(i + 1) * chunk_size]])
+                       for i, (appender, lock) in enumerate(appenders)]
+            responses = [response for future in futures for response in future.result()]
+
+            for mail, (status, response) in zip(appends, responses):
+                try:
+                    if status != 'OK':
+                        raise exceptions.IMAPClientError(imaperror_decode(response))
 
-                    except exceptions.IMAPClientError as e:
-                        e_decoded = imaperror_decode(e)
+                    #: differed IMAP servers have differed return codes
+                    success_messages = [b'append completed', b'(success)']
+                    if any(msg in response.lower() for msg in success_messages):
+                        stats['copied_mails'] += 1
+                    else:
+                        raise exceptions.IMAPClientError(f'Unknown success message: {response.decode()}')
 
-                        try:
-                            msg_id_decoded = msg_id.decode()
-                        except Exception as sub_exception:
-                            msg_id_decoded = f'(decode failure): {sub_exception}'
+                except exceptions.IMAPClientError as e:
+                    try:
+                        msg_id_decoded = mail['msg_id'].decode()
+                    except Exception as sub_exception:
+                        msg_id_decoded = f'(decode failure): {sub_exception}'
 
-                        error_information = {'size': beautysized(size),
-                                             'subject': subject,
-                                             'exception': f'{type(e).__name__}: {e}',
-                                             'folder': df_name,
-                                             'date': date,
-                                             'id': msg_id_decoded}
+                    error_information = {'size': beautysized(mail['size']),
+                                         'subject': get_subject(folder, mail['idx']),
+                                         'exception': f'{type(e).__name__}: {e}',
+                                         'folder': df_name,
+                                         'date': mail['date'],
+                                         'id': msg_id_decoded}
 
-                        stats['errors'].append(error_information)
-                        print(f'\n{colorize("Error:", color="red", bold=True)} {e}\n')
+                    stats['errors'].append(error_information)
+                    print(f'\n{colorize("Error:", color="red", bold=True)} {e}\n')
 
-                        if args.abort_on_error:
-                            raise KeyboardInterrupt
+                    if args.abort_on_error:
+                        raise KeyboardInterrupt
 
-                    finally:
-                        stats['processed'] += 1
+                finally:
+                    stats['processed'] += 1
 
         print(colorize('Folder finished!', clear=True))
 
@@ -670,6 +968,7 @@ else:
 #: stop idle threads
 source_idle.exit()
 destination_idle.exit()
+append_executor.shutdown()
 
 #: logout source
 try:
@@ -679,13 +978,18 @@ try:
 except exceptions.IMAPClientError as e:
     print(f'ERROR: {imaperror_decode(e)}')
 
-#: logout destination
-try:
-    print('Logout destination...', end='', flush=True)
-    destination.logout()
+#: logout destination (a dropped connection of the pool must not keep the others logged in)
+print('Logout destination...', end='', flush=True)
+logout_errors = []
+for client in append_clients:
+    try:
+        client.logout()
+    except (exceptions.IMAPClientError, OSError) as e:
+        logout_errors.append(imaperror_decode(e))
+if logout_errors:
+    print(f'ERROR: {", ".join(logout_errors)}')
+else:
     print(colorize('OK', color='green'))
-except exceptions.IMAPClientError as e:
-    print(f'ERROR: {imaperror_decode(e)}')
 
 
 #: print statistics
@@ -20,7 +20,7 @@ setuptools.setup(
         'Funding': 'https://www.paypal.com/cgi-bin/webscr?cmd=_s-xclick&hosted_button_id=KPG2MY37LCC24&source=url'
     },
     packages=setuptools.find_packages(),
-    py_modules=['imapidle', 'utils'],
+    py_modules=['imapidle', 'imappipeline', 'mailcache', 'utils'],
     install_requires=[
         'chardet',
         'IMAPClient',
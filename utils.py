@@ -1,6 +1,7 @@
 from chardet import detect
 from email.header import decode_header
 from ast import literal_eval
+from time import monotonic
 
 
 def imaperror_decode(e):
@@ -72,3 +73,50 @@ def decode_mime(mime_bytes):
                 words.append(word)
 
     return ''.join(words)
+
+
+class Throttle:
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self._last = None
+
+    def should_emit(self, now=None):
+        """
+        returns True at most once per interval (used to limit the progress output)
+        """
+        if now is None:
+            now = monotonic()
+        if self._last is None or now - self._last >= self.interval:
+            self._last = now
+            return True
+        return False
+
+
+def chunk_by_bytes(uids, max_bytes=8000, limit=None):
+    #: split the uids into chunks, the serialized uid set of each chunk ("1,2,3,") fits into max_bytes
+    chunk = []
+    length = 0
+
+    for uid in uids:
+        uid_length = len(str(uid)) + 1
+        if chunk and (length + uid_length > max_bytes or len(chunk) == limit):
+            yield chunk
+            chunk = []
+            length = 0
+        chunk.append(uid)
+        length += uid_length
+
+    if chunk:
+        yield chunk
+
+
+def exceeds_line_length(msg, max_length):
+    #: looks for a line longer than max_length without splitting the whole message into lines
+    start = 0
+    while True:
+        end = msg.find(b'\n', start)
+        if end == -1:
+            return len(msg) - start > max_length
+        if end - start > max_length:
+            return True
+        start = end + 1